@@ -17,28 +17,40 @@ Either a -f or -p flag is required, but not both.
 """
 
 from __future__ import print_function
-import sys
+import sys, os
 
 import xarray as xr
 from utils.proj import lat_lon_reproj
 from utils.mapinfo import domains
+from utils.shared_grid import grid_signature, publish_grid, attach_grid, subset_grid
 
 import numpy as np
 import argparse
 
 from glob import glob
+from multiprocessing import Pool
 import shutil
+import tempfile
 import warnings
 warnings.simplefilter("ignore")
 
-def reduce_domain(domain=None, domain_box=None, filename=None, local_path=None):
+def get_bounds(domain=None, domain_box=None):
     """
+    Convert a mapinfo.py domain key or a 'LonW LatS LonE LatN' string to a list of
+    bounds.
 
     """
     if domain:
         bounds = domains[domain]
     elif domain_box:
         bounds = [float(x) for x in str(domain_box).strip().split()]
+    return bounds
+
+def reduce_domain(domain=None, domain_box=None, filename=None, local_path=None):
+    """
+
+    """
+    bounds = get_bounds(domain=domain, domain_box=domain_box)
     # Individual file
     if filename is not None:
         execute(filename, bounds)
@@ -46,12 +58,83 @@ def reduce_domain(domain=None, domain_box=None, filename=None, local_path=None):
     # Entire directory
     elif local_path is not None:
         files = glob(local_path + '/OR*.nc')
-        for filename in files:
-            execute(filename, bounds)
+        failures = reduce_files(files, bounds)
+        if len(failures) > 0:
+            print("==>%s file(s) failed to reduce:" % (len(failures)))
+            for filename, error in failures.items():
+                print("    %s (%s)" % (filename, error))
 
     return
 
-def execute(filename, domain):
+def reduce_files(filenames, bounds, processes=1):
+    """
+    Reduce a list of files to the same bounding area. The lat/lon arrays and domain mask
+    are computed once per unique grid by the parent process and written to memory-mapped
+    files which the workers attach to read-only. Memory use therefore stays roughly
+    constant as the number of processes grows.
+
+    Parameters
+    ----------
+    filenames : list
+        Input filenames
+    bounds : list
+        [LonW, LatS, LonE, LatN]
+
+    Other Parameters
+    ----------------
+    processes : int
+        Number of worker processes. Defaults to 1 (run serially).
+
+    Returns
+    -------
+    failures : dict
+        Maps each filename that could not be reduced to its error message. A failure on
+        one file doesn't stop the rest from being reduced.
+
+    """
+    failures = {}
+    if len(filenames) == 0: return failures
+    cache_dir = tempfile.mkdtemp(prefix='.grid_cache_',
+                                 dir=os.path.dirname(os.path.abspath(filenames[0])))
+    try:
+        grids = {}
+        jobs = []
+        for filename in filenames:
+            try:
+                key = grid_signature(filename, bounds)
+                if key not in grids:
+                    grids[key] = publish_grid(filename, bounds, cache_dir, key=key)
+            except Exception as e:
+                failures[filename] = "%s: %s" % (type(e).__name__, e)
+                continue
+            jobs.append((filename, bounds, grids[key]))
+
+        if processes > 1:
+            with Pool(processes) as pool:
+                errors = pool.starmap(_safe_execute, jobs)
+        else:
+            errors = [_safe_execute(*job) for job in jobs]
+        for job, error in zip(jobs, errors):
+            if error is not None: failures[job[0]] = error
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    return failures
+
+def _safe_execute(filename, domain, grid_paths=None):
+    """
+    Wrapper around execute that returns the error message instead of raising, so one bad
+    file doesn't abort the rest of a batch.
+
+    """
+    try:
+        execute(filename, domain, grid_paths=grid_paths)
+    except Exception as e:
+        if os.path.exists(filename + '.temp'): os.remove(filename + '.temp')
+        return "%s: %s" % (type(e).__name__, e)
+    return None
+
+def execute(filename, domain, grid_paths=None):
     """
     Read input file with xarray. Alter domain bounding area. Output
     a temporary file and then replace this with the original.
@@ -60,26 +143,33 @@ def execute(filename, domain):
     ----------
     filename: str
         Input filename
+    domain: list
+        [LonW, LatS, LonE, LatN]
+
+    Other Parameters
+    ----------------
+    grid_paths: dict
+        Output from utils.shared_grid.publish_grid. If specified, the domain mask and
+        indices are attached read-only from these instead of being recomputed.
 
     Returns
     -------
     Altered netCDF file.
 
     """
-    lon, lat, X, Y = lat_lon_reproj(filename)
-    idx_lat = np.where(np.logical_and(lat>=domain[1], lat<=domain[3]))
-    idx_lon = np.where(np.logical_and(lon>=domain[0], lon<=domain[2]))
-    idx_y = np.intersect1d(idx_lat[0], idx_lon[0])
-    idx_x = np.intersect1d(idx_lat[1], idx_lon[1])
-    ds = xr.open_dataset(filename)
-    ds.CMI.values = np.where(np.logical_and(np.logical_and(lat>domain[1], lat<domain[3]),
-                            np.logical_and(lon>domain[0], lon<domain[2])),
-                            ds.CMI.values, np.nan)
+    if grid_paths is not None:
+        grid = attach_grid(grid_paths)
+    else:
+        lon, lat, X, Y = lat_lon_reproj(filename)
+        grid = subset_grid(lon, lat, domain)
 
-    ds = ds.sel(x=X[idx_x], y=Y[idx_y])
+    ds = xr.open_dataset(filename)
+    ds = ds.isel(x=np.asarray(grid['idx_x']), y=np.asarray(grid['idx_y']))
+    ds.CMI.values = np.where(grid['mask'], ds.CMI.values, np.nan)
     print("====> Altering domain of %s" % (filename))
 
     ds.to_netcdf(filename + '.temp')
+    ds.close()
     shutil.move(filename + '.temp', filename)
 
     return
@@ -20,7 +20,10 @@ import itertools
 import s3fs
 import re
 
-from multiprocessing import Pool
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from domain_reduce import get_bounds, reduce_files
+from utils.transfer import AdaptiveScheduler, ranged_get
 
 try:
     from shutil import which
@@ -34,6 +37,14 @@ if not WGET:
 if not WGET and not CURL:
     raise ValueError("Neither wget nor curl found on the system. Exiting")
 
+# Objects at least this large are downloaded as concurrent byte ranges. This is aimed at
+# full disk band 2 files (hundreds of MB). get_data_aws only lists the CONUS and mesoscale
+# CMIP products for now, and those are typically well below this, so they are still
+# fetched as a single stream. Lower this to split CONUS band 2 files as well.
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_PART_SIZE = 16 * 1024 * 1024
+MULTIPART_STREAMS = 8
+
 #[OI][RT]_ABI-L2-\w{4}(C|F|M1|M2)-M\dC%s_G\d\d_s\d{14}_e\d{14}_c\d{14}.nc
 regex_str = "_s([\d]{14})"
 metadata = {
@@ -168,8 +179,12 @@ def get_data_aws(start_time, end_time, local_path=None, bands=None, glm=None, do
                     scan_dt = datetime.strptime(scan_string, '%Y%j%H%M%S')
 
                     if dt_start <= scan_dt <= dt_end:
-                        downloads[f] = local_path + '/' + fname
-                        download_size += fs.info(f)['size']
+                        # Keep the listed size and ETag so the downloads don't have
+                        # to query them again.
+                        info = fs.info(f)
+                        downloads[f] = (local_path + '/' + fname, info['size'],
+                                        info.get('ETag'))
+                        download_size += info['size']
 
     # Query user if they'd like to continue based on expected download size
     for key in downloads.keys():
@@ -180,20 +195,40 @@ def get_data_aws(start_time, end_time, local_path=None, bands=None, glm=None, do
     print(str1, round(download_size / 1000000.), str2)
     resp = input()
 
-    if domain is not None:
-        domains = [domain for i in range(len(list(downloads.keys())))]
-        domain_boxes = [None for i in range(len(list(downloads.keys())))]
-    else:
-        domain_boxes = [domain_box for i in range(len(list(downloads.keys())))]
-        domains = [None for i in range(len(list(downloads.keys())))]
-
     if resp in ['y', 'Y', 'yes']:
         timeit = datetime.now()
-        with Pool(8) as pool:
-            pool.starmap(download_aws, zip(list(downloads.keys()),
-                                           list(downloads.values()),
-                                           domains,
-                                           domain_boxes))
+        # The number of simultaneous downloads adapts to throughput and S3 throttling.
+        # Failed downloads are retried with backoff and reported at the end.
+        # Byte ranges of large objects count against the same concurrency limit.
+        scheduler = AdaptiveScheduler(partial(download_aws, fs=fs), max_workers=16,
+                                      initial_workers=8,
+                                      streams=partial(download_streams, fs=fs))
+        failures = scheduler.run([(url,) + job for url, job in downloads.items()])
+        if len(failures) > 0:
+            print("==>%s file(s) failed to download:" % (len(failures)))
+            for filename, errors in failures.items():
+                print("    %s (%s)" % (filename, errors[-1]))
+        completed = [job[0] for job in downloads.values() if job[0] not in failures]
+
+        # Pass the files to fix_wavelengths for proper AWIPS-read in. This is kept out of
+        # the scheduled downloads so its CPU time doesn't skew the throughput estimates.
+        with ThreadPool(8) as pool:
+            returncodes = pool.map(fix_wavelengths, completed)
+        failures = [f for f, code in zip(completed, returncodes) if code != 0]
+        if len(failures) > 0:
+            print("==>%s file(s) failed wavelength fix:" % (len(failures)))
+            for filename in failures:
+                print("    %s" % (filename))
+
+        # Domain reduction happens after all downloads are complete so the grid geometry
+        # and subset mask can be computed once per grid and shared across the workers.
+        if domain is not None or domain_box is not None:
+            bounds = get_bounds(domain=domain, domain_box=domain_box)
+            failures = reduce_files(completed, bounds, processes=8)
+            if len(failures) > 0:
+                print("==>%s file(s) failed to reduce:" % (len(failures)))
+                for filename, error in failures.items():
+                    print("    %s (%s)" % (filename, error))
         timeit = (datetime.now()-timeit).seconds
         print("Download took: %s minutes" % (int(timeit / 60.)))
     else:
@@ -203,7 +238,18 @@ def get_data_aws(start_time, end_time, local_path=None, bands=None, glm=None, do
         sys.exit(0)
     return
 
-def download_aws(url, filename, domain, dbox):
+def download_streams(url, filename, size=None, etag=None, fs=None):
+    """
+    Number of concurrent requests download_aws would like to use for a file.
+
+    """
+    if size is None:
+        if fs is None: fs = s3fs.S3FileSystem(anon=True)
+        size = fs.info(url)['size']
+    if size < MULTIPART_THRESHOLD: return 1
+    return min(MULTIPART_STREAMS, -(-size // MULTIPART_PART_SIZE))
+
+def download_aws(url, filename, size=None, etag=None, fs=None, streams=1):
     """
     Perform downloading of netCDF files from AWS
 
@@ -216,28 +262,47 @@ def download_aws(url, filename, domain, dbox):
 
     Other Parameters
     ----------------
-    domain : string
-        String corresponding to a key in the mapinfo.py domains dictionary
-    domain_box : string
-        String in the form 'LonW LatS LonE LatN'
+    size : int
+        Listed size of the object in bytes. Queried from S3 if not specified.
+    etag : string
+        Listed ETag of the object. Used to verify ranged downloads.
+    fs : s3fs.S3FileSystem
+        Filesystem to download from. Creates an anonymous S3 connection if not specified.
+    streams : int
+        Number of byte ranges to fetch concurrently for large objects. Defaults to 1.
+
+    Returns
+    -------
+    size : int
+        Number of bytes transferred
 
     """
-    fs = s3fs.S3FileSystem(anon=True)
+    if fs is None: fs = s3fs.S3FileSystem(anon=True)
     print("Downloading: ", filename)
-    fs.get(url, filename)
+    try:
+        # Large objects (i.e. full disk band 2) are split into byte ranges fetched in
+        # parallel. A single stream isn't able to saturate the link for these.
+        if size is None:
+            info = fs.info(url)
+            size, etag = info['size'], info.get('ETag')
+        if size >= MULTIPART_THRESHOLD and streams > 1:
+            ranged_get(fs, url, filename, size, etag=etag,
+                       part_size=MULTIPART_PART_SIZE, max_workers=streams)
+        else:
+            fs.get(url, filename)
+    except Exception:
+        # Don't leave a partial file behind for the retry or the user to trip over.
+        if os.path.exists(filename): os.remove(filename)
+        raise
+    return size
+
+def fix_wavelengths(filename):
+    """
+    Run fix_wavelengths.py on a downloaded file. Returns the exit code of the script.
 
-    # Pass this file to fix_wavelengths for proper AWIPS-read in
+    """
     arg = 'python fix_wavelengths.py -f %s' % (filename)
-    call(arg, shell=True)
-
-    reduce = False
-    if domain is not None:
-        arg = "./domain_reduce.py -d %s -f %s" % (domain, filename)
-        reduce = True
-    elif dbox is not None:
-        arg = "./domain_reduce.py -dbox '%s' -f %s" % (dbox, filename)
-        reduce = True
-    if reduce: call(arg, shell=True)
+    return call(arg, shell=True)
 
 def grab_data_goes_N(start_time, end_time, local_path=None, domain=None, domain_box=None):
     """
@@ -0,0 +1,183 @@
+#! /usr/bin/env python3
+
+"""
+Exercise the adaptive download scheduler in utils/transfer.py against a local fake S3
+that injects latency and errors. No network access or AWS credentials are needed.
+
+Useage
+------
+python transfer_debug.py
+
+Each check prints PASS/FAIL and the script exits non-zero if any check fails.
+"""
+import os
+import sys
+import time
+import random
+import hashlib
+import shutil
+import tempfile
+import threading
+
+from utils.transfer import AdaptiveScheduler, ranged_get
+
+class FakeS3FileSystem(object):
+    """
+    Stand-in for s3fs.S3FileSystem. Every object is `size` bytes long.
+
+    Parameters
+    ----------
+    latency : float
+        Seconds per transfer when at most `capacity` transfers are in flight. Beyond that
+        the link is shared, so latency grows with the number of active transfers.
+    capacity : int
+        Number of concurrent transfers the fake link can carry at full speed.
+    error_rate : float
+        Probability that any request fails with a transient error.
+    throttle_above : int
+        Requests fail with SlowDown while more than this many are in flight.
+    missing : set
+        Keys that always fail with FileNotFoundError.
+
+    """
+    def __init__(self, size=1000, latency=0.01, capacity=64, error_rate=0.,
+                 throttle_above=None, missing=None, seed=0):
+        self.size = size
+        self.latency = latency
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.throttle_above = throttle_above
+        self.missing = missing or set()
+        self.random = random.Random(seed)
+        self.calls = {}
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def info(self, url):
+        return {'size': self.size, 'ETag': '"%s-2"' % ('0' * 32)}
+
+    def _request(self, url):
+        with self.lock:
+            self.active += 1
+            active = self.active
+            self.max_active = max(self.max_active, active)
+            self.calls[url] = self.calls.get(url, 0) + 1
+            fail = self.random.random() < self.error_rate
+        try:
+            if url in self.missing: raise FileNotFoundError(url)
+            if self.throttle_above is not None and active > self.throttle_above:
+                time.sleep(self.latency / 4.)
+                raise IOError("SlowDown")
+            time.sleep(self.latency * max(1., active / float(self.capacity)))
+            if fail: raise IOError("InternalError")
+        finally:
+            with self.lock: self.active -= 1
+
+    def get(self, url, filename):
+        self._request(url)
+        with open(filename, 'wb') as f:
+            f.write(b'\0' * self.size)
+
+    def cat_file(self, url, start=None, end=None):
+        self._request(url)
+        return b'\0' * (end - start)
+
+def fetcher(fs):
+    def fetch(url, filename):
+        fs.get(url, filename)
+        return fs.info(url)['size']
+    return fetch
+
+def check(name, ok):
+    print("%s: %s" % ('PASS' if ok else 'FAIL', name))
+    return ok
+
+def main():
+    tmp = tempfile.mkdtemp()
+    jobs = [('bucket/file%03d.nc' % (i), os.path.join(tmp, 'file%03d.nc' % (i)))
+            for i in range(200)]
+    results = []
+    rand = random.Random(0).random
+    try:
+        # Retries and the per-file failure report
+        fs = FakeS3FileSystem(error_rate=0.1, missing={'bucket/missing.nc'})
+        scheduler = AdaptiveScheduler(fetcher(fs), initial_workers=4, retries=4,
+                                      base_delay=0.001, max_delay=0.01, rand=rand)
+        failures = scheduler.run(jobs + [('bucket/missing.nc', os.path.join(tmp, 'x'))])
+        results.append(check("transient errors are retried until success",
+                             all(os.path.exists(f) for u, f in jobs)))
+        results.append(check("permanent failure attempted 1 + 4 retries",
+                             fs.calls['bucket/missing.nc'] == 5))
+        results.append(check("failure report lists only the missing file",
+                             list(failures) == [os.path.join(tmp, 'x')] and
+                             len(failures[os.path.join(tmp, 'x')]) == 5))
+
+        # Limit grows while the link still has spare capacity
+        fs = FakeS3FileSystem(latency=0.02, capacity=12)
+        scheduler = AdaptiveScheduler(fetcher(fs), initial_workers=1, max_workers=16,
+                                      rand=rand)
+        scheduler.run(jobs)
+        peak = max(h[0] for h in scheduler.history)
+        results.append(check("limit increases on an uncongested link (peak %s)" % (peak),
+                             peak >= 6))
+
+        # Limit is cut back under throttling
+        fs = FakeS3FileSystem(latency=0.01, throttle_above=4)
+        scheduler = AdaptiveScheduler(fetcher(fs), initial_workers=12, max_workers=16,
+                                      base_delay=0.001, max_delay=0.01, rand=rand)
+        failures = scheduler.run(jobs)
+        limits = [h[0] for h in scheduler.history]
+        results.append(check("limit decreases under throttling (limits %s...)" %
+                             (limits[:6]), min(limits) <= 4 and len(failures) == 0))
+
+        # Limit falls to the minimum with a high error rate
+        fs = FakeS3FileSystem(error_rate=0.2, seed=1)
+        scheduler = AdaptiveScheduler(fetcher(fs), initial_workers=8, retries=8,
+                                      base_delay=0.001, max_delay=0.01, rand=rand)
+        scheduler.run(jobs)
+        results.append(check("limit falls to 1 with 20% errors",
+                             min(h[0] for h in scheduler.history) == 1))
+
+        # Byte ranges of large objects count against the concurrency limit
+        fs = FakeS3FileSystem(size=8000, latency=0.01)
+        def fetch(url, filename, streams=1):
+            return ranged_get(fs, url, filename, fs.size, part_size=1000,
+                              max_workers=streams)
+        scheduler = AdaptiveScheduler(fetch, initial_workers=8, max_workers=8,
+                                      streams=lambda url, filename: 8, rand=rand)
+        failures = scheduler.run(jobs[:40])
+        results.append(check("ranged requests stay within the limit (max %s)" %
+                             (fs.max_active), fs.max_active <= 8 and len(failures) == 0))
+
+        # A failed range stops the remaining ranges instead of fetching the whole file
+        fs = FakeS3FileSystem(size=8000, error_rate=1.)
+        try:
+            ranged_get(fs, 'bucket/big.nc', os.path.join(tmp, 'big.nc'), fs.size,
+                       part_size=1000, max_workers=2)
+            raised = False
+        except IOError:
+            raised = True
+        results.append(check("failed range stops the download (%s of 8 requested)" %
+                             (fs.calls['bucket/big.nc']),
+                             raised and fs.calls['bucket/big.nc'] < 8))
+
+        # ETag verification of single-part objects
+        fs = FakeS3FileSystem(size=8000)
+        etag = '"%s"' % (hashlib.md5(b'\0' * fs.size).hexdigest())
+        ranged_get(fs, 'bucket/big.nc', os.path.join(tmp, 'big.nc'), fs.size, etag=etag,
+                   part_size=1000, max_workers=4)
+        try:
+            ranged_get(fs, 'bucket/big.nc', os.path.join(tmp, 'big.nc'), fs.size,
+                       etag='"%s"' % ('0' * 32), part_size=1000, max_workers=4)
+            raised = False
+        except IOError:
+            raised = True
+        results.append(check("matching ETag passes and a mismatched one raises", raised))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    if not all(results): sys.exit(1)
+
+if __name__ == "__main__":
+    main()
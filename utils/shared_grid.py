@@ -0,0 +1,127 @@
+"""
+Helpers for sharing GOES domain subsets between processes. The parent computes the
+lat/lon arrays once per unique grid, reduces them to the subset mask and x/y indices, and
+writes those to memory-mapped .npy files. Workers then attach to these read-only rather
+than each building their own multi-GB copy of the lat/lon arrays.
+"""
+import os
+import hashlib
+
+import numpy as np
+import xarray as xr
+
+from utils.proj import lat_lon_reproj
+
+PROJ_ATTRS = ['longitude_of_projection_origin', 'perspective_point_height',
+              'semi_major_axis', 'semi_minor_axis']
+ARRAYS = ['mask', 'idx_x', 'idx_y']
+
+def grid_signature(filename, bounds):
+    """
+    Build a key identifying the grid (projection + x/y coordinates) and subset bounds of
+    a file. Files sharing a key can share one set of geometry arrays.
+
+    Parameters
+    ----------
+    filename : string
+        Path to a GOES netCDF file
+    bounds : list
+        [LonW, LatS, LonE, LatN]
+
+    Returns
+    -------
+    key : string
+        Hex digest unique to this grid and set of bounds
+
+    """
+    ds = xr.open_dataset(filename)
+    proj_info = ds.goes_imager_projection
+    sha = hashlib.sha1()
+    for attr in PROJ_ATTRS:
+        sha.update(repr(float(getattr(proj_info, attr))).encode())
+    sha.update(np.ascontiguousarray(ds.x.values).tobytes())
+    sha.update(np.ascontiguousarray(ds.y.values).tobytes())
+    ds.close()
+    sha.update(repr([float(b) for b in bounds]).encode())
+    return sha.hexdigest()
+
+def subset_grid(lon, lat, bounds):
+    """
+    Compute the x/y indices of the bounding area and the domain mask cropped to them.
+
+    Parameters
+    ----------
+    lon, lat : array
+        2D longitude and latitude arrays from utils.proj.lat_lon_reproj
+    bounds : list
+        [LonW, LatS, LonE, LatN]
+
+    Returns
+    -------
+    grid : dict
+        Contains the mask, idx_x and idx_y arrays. mask has shape (len(idx_y),
+        len(idx_x)) and applies to the data after it has been reduced to idx_y/idx_x.
+
+    """
+    idx_lat = np.where(np.logical_and(lat>=bounds[1], lat<=bounds[3]))
+    idx_lon = np.where(np.logical_and(lon>=bounds[0], lon<=bounds[2]))
+    idx_y = np.intersect1d(idx_lat[0], idx_lon[0])
+    idx_x = np.intersect1d(idx_lat[1], idx_lon[1])
+    box = np.ix_(idx_y, idx_x)
+    lon, lat = lon[box], lat[box]
+    mask = np.logical_and(np.logical_and(lat>bounds[1], lat<bounds[3]),
+                          np.logical_and(lon>bounds[0], lon<bounds[2]))
+    return {'mask': mask, 'idx_x': idx_x, 'idx_y': idx_y}
+
+def publish_grid(filename, bounds, cache_dir, key=None):
+    """
+    Compute the domain subset for a file's grid and write it to memory-mapped .npy files
+    in cache_dir. Skips the computation if this grid has already been published.
+
+    Parameters
+    ----------
+    filename : string
+        Path to a GOES netCDF file
+    bounds : list
+        [LonW, LatS, LonE, LatN]
+    cache_dir : string
+        Directory to store the .npy files in
+    key : string
+        Output from grid_signature. Computed if not specified.
+
+    Returns
+    -------
+    paths : dict
+        Path to the .npy file for each of the subset arrays. Pass this to attach_grid.
+
+    """
+    if key is None: key = grid_signature(filename, bounds)
+    paths = {}
+    for name in ARRAYS:
+        paths[name] = os.path.join(cache_dir, '%s_%s.npy' % (key, name))
+
+    if not all(os.path.exists(path) for path in paths.values()):
+        lon, lat, X, Y = lat_lon_reproj(filename)
+        grid = subset_grid(lon, lat, bounds)
+        for name in ARRAYS:
+            # Write to a temporary name first so a reader never sees a partial file.
+            np.save(paths[name] + '.temp.npy', grid[name])
+            os.replace(paths[name] + '.temp.npy', paths[name])
+    return paths
+
+def attach_grid(paths):
+    """
+    Open published subset arrays read-only without copying them into memory.
+
+    Parameters
+    ----------
+    paths : dict
+        Output from publish_grid
+
+    Returns
+    -------
+    grid : dict
+        Read-only, memory-mapped mask, idx_x and idx_y arrays
+
+    """
+    return {name: np.load(path, mmap_mode='r') for name, path in paths.items()}
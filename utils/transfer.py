@@ -0,0 +1,314 @@
+"""
+Adaptive concurrency control for AWS transfers. Rather than a fixed pool size, the number
+of in-flight transfers is adjusted AIMD-style: it grows by one while aggregate throughput
+keeps improving and is halved whenever transfers fail (i.e. S3 throttling or a saturated
+link). Failed transfers are retried with jittered exponential backoff and anything that
+still fails is returned in a per-file report instead of aborting the remaining downloads.
+
+The transfer itself is a plain callable, so a fake filesystem that injects latency and
+errors can be substituted for S3 when testing.
+
+Large objects (i.e. full disk 0.5 km band 2 files) can be fetched with ranged_get, which
+splits them into byte ranges downloaded concurrently into a preallocated file so a single
+file isn't limited by the throughput of one TCP stream.
+"""
+import os
+import time
+import hashlib
+import heapq
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+def backoff_delay(attempt, base_delay=1., max_delay=30., rand=random.random):
+    """
+    Full-jitter exponential backoff: a random delay between 0 and
+    min(max_delay, base_delay * 2**attempt) seconds.
+
+    """
+    return rand() * min(max_delay, base_delay * (2 ** attempt))
+
+def _write_at(fd, data, offset, lock):
+    """
+    Positional write. os.pwrite isn't available on Windows, so fall back to a locked
+    seek and write there.
+
+    """
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while len(view) > 0:
+            n = os.pwrite(fd, view, offset)
+            view = view[n:]
+            offset += n
+    else:
+        with lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+
+def verify_etag(filename, etag):
+    """
+    Check a downloaded file against the ETag of a single-part upload, which is the MD5
+    of the object. Multipart ETags contain a '-' and aren't an MD5 of the content, so
+    these (and missing ETags) are skipped.
+
+    """
+    etag = (etag or '').strip('"')
+    if len(etag) == 32 and '-' not in etag:
+        md5 = hashlib.md5()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(8 * 1024 * 1024), b''):
+                md5.update(chunk)
+        if md5.hexdigest() != etag:
+            raise IOError("%s failed checksum. Expected ETag %s, got %s" %
+                          (filename, etag, md5.hexdigest()))
+
+def ranged_get(fs, url, filename, size, etag=None, part_size=16*1024*1024,
+               max_workers=8):
+    """
+    Download an object as concurrent byte ranges written into a preallocated file. The
+    number of bytes written must match the listed size, and the file is checked against
+    the ETag when it is an MD5 (see verify_etag).
+
+    Parameters
+    ----------
+    fs : s3fs.S3FileSystem
+        Filesystem to download from. Must provide cat_file(path, start, end).
+    url : string
+        Full URL to online file
+    filename : string
+        Path and name to store on local system
+    size : int
+        Listed size of the object in bytes
+
+    Other Parameters
+    ----------------
+    etag : string
+        Listed ETag of the object. Used for verification when available.
+    part_size : int
+        Size of each byte range. Defaults to 16 MB.
+    max_workers : int
+        Number of ranges fetched concurrently. Defaults to 8.
+
+    A failed range is not retried here. The error is raised so that AdaptiveScheduler
+    sees it, backs off its concurrency and retries the whole file.
+
+    Returns
+    -------
+    size : int
+        Number of bytes downloaded
+
+    """
+    ranges = [(start, min(start + part_size, size))
+              for start in range(0, size, part_size)]
+    lock = threading.Lock()
+    stop = threading.Event()
+    written = [0]
+
+    def fetch_range(start, end):
+        # Once any range has failed the file will be retried, so don't start new requests
+        if stop.is_set(): return
+        try:
+            data = fs.cat_file(url, start=start, end=end)
+            if len(data) != end - start:
+                raise IOError("Short read of %s bytes %s-%s" % (url, start, end))
+        except Exception:
+            stop.set()
+            raise
+        if stop.is_set(): return
+        _write_at(fd, data, start, lock)
+        with lock:
+            written[0] += len(data)
+
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+    fd = os.open(filename, flags)
+    try:
+        os.ftruncate(fd, size)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(fetch_range, start, end) for start, end in ranges]
+            try:
+                for future in futures:
+                    future.result()
+            except Exception:
+                stop.set()
+                for future in futures: future.cancel()
+                raise
+    finally:
+        os.close(fd)
+
+    if written[0] != size:
+        raise IOError("%s: wrote %s bytes, expected %s" % (filename, written[0], size))
+    verify_etag(filename, etag)
+    return size
+
+class AdaptiveScheduler(object):
+    """
+    Run transfers with an adaptive number of concurrent workers.
+
+    Parameters
+    ----------
+    fetch : callable
+        Called as fetch(url, filename, ...) with the contents of each job. Should return
+        the number of bytes transferred and raise an exception on failure.
+
+    Other Parameters
+    ----------------
+    min_workers : int
+        Lower bound on concurrent transfers. Defaults to 1.
+    max_workers : int
+        Upper bound on concurrent transfers. Defaults to 16.
+    initial_workers : int
+        Starting number of concurrent transfers. Defaults to 4.
+    retries : int
+        Number of times to retry a failed transfer. Defaults to 4.
+    base_delay, max_delay : float
+        Backoff parameters in seconds. See backoff_delay.
+    window : int
+        Number of completed attempts between concurrency adjustments. Defaults to the
+        current concurrency limit.
+    tolerance : float
+        Fractional change in throughput treated as noise. Defaults to 0.05.
+    rand : callable
+        Source of random numbers in [0, 1) for the backoff jitter.
+    streams : callable
+        Called as streams(url, filename, ...) to get the number of concurrent requests a
+        job would like to use (i.e. byte ranges of a large object). Each job takes that
+        many slots of the concurrency limit, capped at the slots free when it starts,
+        and fetch is called with the granted count as a `streams` keyword. By default
+        every job uses one slot.
+
+    Attributes
+    ----------
+    history : list
+        (limit, throughput, errors) after each window. Useful for checking how the limit
+        moved.
+
+    """
+    def __init__(self, fetch, min_workers=1, max_workers=16, initial_workers=4,
+                 retries=4, base_delay=1., max_delay=30., window=None, tolerance=0.05,
+                 rand=random.random, streams=None):
+        self.fetch = fetch
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.limit = float(min(max(initial_workers, self.min_workers), self.max_workers))
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.window = window
+        self.tolerance = tolerance
+        self.rand = rand
+        self.streams = streams
+        self.history = []
+
+        self._lock = threading.Lock()
+        self._reset_window(None)
+
+    def _reset_window(self, throughput):
+        self._prev_throughput = throughput
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_done = 0
+        self._window_errors = 0
+
+    def _record(self, nbytes, error):
+        """
+        Account for a completed attempt and adjust the concurrency limit once a full
+        window of attempts has completed.
+
+        """
+        with self._lock:
+            self._window_done += 1
+            if error:
+                self._window_errors += 1
+            else:
+                self._window_bytes += nbytes
+
+            window = self.window or max(1, int(self.limit))
+            if self._window_done < window: return
+
+            elapsed = max(time.monotonic() - self._window_start, 1e-6)
+            throughput = self._window_bytes / elapsed
+            prev = self._prev_throughput
+            if self._window_errors > 0:
+                # Multiplicative decrease on errors/throttling
+                self.limit = max(self.min_workers, self.limit / 2.)
+            elif prev is None or throughput > prev * (1. + self.tolerance):
+                # Additive increase while adding transfers still buys throughput
+                self.limit = min(self.max_workers, self.limit + 1.)
+            elif throughput < prev * (1. - self.tolerance):
+                self.limit = max(self.min_workers, self.limit - 1.)
+            self.history.append((int(self.limit), throughput, self._window_errors))
+            self._reset_window(throughput)
+
+    def _attempt(self, *job, **kwargs):
+        try:
+            nbytes = self.fetch(*job, **kwargs)
+        except Exception:
+            self._record(0, True)
+            raise
+        self._record(nbytes or 0, False)
+        return nbytes
+
+    def run(self, jobs):
+        """
+        Transfer every job in jobs. Each job is a (url, filename, ...) tuple passed to
+        fetch. Any extra items (i.e. the listed size) are passed through as well.
+
+        Returns
+        -------
+        failures : dict
+            Maps each filename that could not be transferred after all retries to a list
+            of the error messages from each attempt. Empty if everything succeeded.
+
+        """
+        pending = [(job, 0) for job in jobs][::-1]
+        retry_queue = []
+        errors = {}
+        failures = {}
+        in_flight = {}
+        used = 0
+        counter = 0
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or retry_queue or in_flight:
+                now = time.monotonic()
+                while retry_queue and retry_queue[0][0] <= now:
+                    _, _, job, attempt = heapq.heappop(retry_queue)
+                    pending.append((job, attempt))
+
+                while pending and used < int(self.limit):
+                    job, attempt = pending.pop()
+                    slots, kwargs = 1, {}
+                    if self.streams is not None:
+                        slots = max(1, min(self.streams(*job), int(self.limit) - used))
+                        kwargs['streams'] = slots
+                    future = executor.submit(self._attempt, *job, **kwargs)
+                    in_flight[future] = (job, attempt, slots)
+                    used += slots
+
+                if not in_flight:
+                    # Only backed-off retries remain. Wait for the next to come due.
+                    time.sleep(max(0., retry_queue[0][0] - time.monotonic()))
+                    continue
+
+                timeout = None
+                if retry_queue: timeout = max(0., retry_queue[0][0] - time.monotonic())
+                done, _ = wait(list(in_flight), timeout=timeout,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, attempt, slots = in_flight.pop(future)
+                    used -= slots
+                    error = future.exception()
+                    if error is None: continue
+
+                    filename = job[1]
+                    errors.setdefault(filename, []).append(
+                        "%s: %s" % (type(error).__name__, error))
+                    if attempt < self.retries:
+                        delay = backoff_delay(attempt, self.base_delay, self.max_delay,
+                                              rand=self.rand)
+                        counter += 1
+                        heapq.heappush(retry_queue, (time.monotonic() + delay, counter,
+                                                     job, attempt + 1))
+                    else:
+                        failures[filename] = errors[filename]
+        return failures